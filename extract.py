@@ -1,88 +1,241 @@
 import pandas as pd
 import requests
 import json
+import orjson
 import re
 import unicodedata
 import pytz 
 from datetime import datetime, timedelta
 import time
+import threading
 import os  
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from google.cloud import storage
 
 BITRIX_WEBHOOK = "https://diet-hub.bitrix24.com/rest/625003/f2ijr5q7sa4w5z6g/"
 METHOD = "voximplant.statistic.get"
+PAGE_SIZE = 50
+MAX_WORKERS = 8
+BATCH_SIZE = 50  # Bitrix accepts at most 50 commands per batch call
 
+# Shared keep-alive session for every Bitrix call. Retries (including 429s,
+# honoring Retry-After) are handled by the adapter instead of by hand.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset(["GET", "POST"]),
+        respect_retry_after_header=True,
+    ),
+))
 
-def fetch_deals_from_bitrix(days=1):
 
-    since_date = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
-    print(f"Fetching Calls Modified ( Updated) since {since_date}...")
-    
-    all_deals = []
-    start = 0
-    
-    while True:
-        params = {
-            "filter": {">=Call_Start_Date": since_date},
-            "select": ["*"], 
-
-            "order": {"Call_Start_Date": "ASC"}, 
-            "start": start
-        }
-
-        # --- Retry Logic Loop ---
-        max_retries = 30
-        attempt = 0
-        success = False
-        
-        while attempt < max_retries:
+class TokenBucket:
+    """
+    Thread-safe token bucket: acquire() blocks until a request may be sent,
+    so callers stay under Bitrix's rate limit instead of reacting to 429s.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                time.sleep((1 - self.tokens) / self.rate)
+
+
+# Bitrix allows ~2 requests per second per portal
+BITRIX_LIMITER = TokenBucket(rate=2, capacity=2)
+
+
+def bitrix_post(method, params):
+    BITRIX_LIMITER.acquire()
+    return SESSION.post(f"{BITRIX_WEBHOOK}/{method}", json=params, timeout=60)
+
+
+def bitrix_list_all(method):
+    """
+    Fetches every page of a Bitrix list method. The first page gives the
+    total; the remaining pages are sent as `batch` calls of up to 50
+    sub-requests each, instead of one HTTP round trip per page.
+    Pages that fail after the first one are logged and skipped, so the
+    items collected so far are still returned.
+    """
+    response = bitrix_post(method, {"start": 0})
+    response.raise_for_status()
+    data = orjson.loads(response.content)
+
+    items = list(data.get("result", []))
+    if "next" not in data:
+        return items
+
+    if "total" not in data:
+        # Nothing to plan batches from: follow `next` page by page
+        start = data["next"]
+        while True:
             try:
-                response = requests.post(f"{BITRIX_WEBHOOK}/{METHOD}", json=params)
-                
-                
-                if response.status_code == 429:
-                    print(f"  Rate Limit hit (429). Cooling down for 10 seconds...")
-                    time.sleep(10) 
-                    attempt += 1
-                    continue 
-                
+                response = bitrix_post(method, {"start": start})
                 response.raise_for_status()
-                
-                data = response.json()
-                success = True
-                break 
-                
-            except requests.exceptions.RequestException as e:
-                print(f"  Network error: {e}. Retrying in 5s...")
-                time.sleep(5)
-                attempt += 1
-
-        if not success:
-            print(f" Failed to fetch batch at start {start} after {max_retries} attempts. Stopping.")
-            break
-            
-        # --- Process Data ---
-        batch = data.get('result', [])
-        if not batch:
-            break
-            
-        all_deals.extend(batch)
-        print(f"   Fetched batch (start={start})... Total collected: {len(all_deals)}")
-        
-        # Pagination Check
-        if 'next' in data and len(batch) >= 50:
-            start = data['next']
-            
-            time.sleep(0.5) 
+                page = orjson.loads(response.content)
+            except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
+                print(f"  Failed to fetch {method} at start {start}: {e}")
+                break
+            items.extend(page.get("result", []))
+            if "next" not in page:
+                break
+            start = page["next"]
+        return items
+
+    starts = list(range(PAGE_SIZE, data["total"], PAGE_SIZE))
+    for i in range(0, len(starts), BATCH_SIZE):
+        cmd = {f"p{s}": f"{method}?start={s}" for s in starts[i:i + BATCH_SIZE]}
+        try:
+            response = bitrix_post("batch", {"halt": 0, "cmd": cmd})
+            response.raise_for_status()
+            result = orjson.loads(response.content).get("result", {})
+        except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
+            print(f"  Batch failed for {method} pages {list(cmd)}: {e}")
+            continue
+
+        if result.get("result_error"):
+            print(f"  Batch errors for {method}: {result['result_error']}")
+
+        pages = result.get("result") or {}
+        for key in cmd:
+            items.extend(pages.get(key) or [])
+
+    return items
+
+
+# Values Bitrix (or earlier str() casts) use for "empty"
+STRING_SENTINELS = {'False', 'nan', 'NaT', 'None', ''}
+
+
+def normalize_missing(df):
+    """
+    Replaces the empty-value sentinels (False, and STRING_SENTINELS after
+    stripping whitespace) with pd.NA in every column, so downstream helpers
+    only need pd.isna. False is matched by identity in object columns:
+    0 and 0.0 compare equal to it and must be kept.
+    """
+    for col in df.columns:
+        s = df[col]
+        if s.dtype == object:
+            # Object columns can also hold lists (unhashable for isin)
+            missing = s.map(lambda v: v is False or (isinstance(v, str) and v.strip() in STRING_SENTINELS))
+        elif pd.api.types.is_bool_dtype(s.dtype):
+            # Bitrix sends False for empty fields; an all-False field arrives as bool
+            missing = s.eq(False)
+        elif pd.api.types.is_string_dtype(s.dtype):
+            missing = s.str.strip().isin(STRING_SENTINELS)
         else:
-            break
-            
-    df = pd.DataFrame(all_deals)
-    
-    
-    if not df.empty:
-        df = df.drop_duplicates(subset='ID', keep='last')
-        
+            continue
+        df[col] = s.mask(missing.fillna(False).astype(bool), pd.NA)
+    return df
+
+
+def _fetch_page(params):
+    try:
+        response = bitrix_post(METHOD, params)
+        response.raise_for_status()
+        return orjson.loads(response.content)
+    except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
+        print(f" Failed to fetch batch at start {params['start']}: {e}")
+        return None
+
+
+def _iter_pages(base_params, first):
+    """
+    Yields (start, page) for the pages after `first`, in order. With a
+    total, the pages are fetched concurrently; without one, `next` is
+    followed one request at a time. Closing the generator cancels any
+    requests still queued.
+    """
+    if 'total' not in first:
+        start = first['next']
+        while True:
+            page = _fetch_page({**base_params, "start": start})
+            yield start, page
+            if page is None or 'next' not in page:
+                return
+            start = page['next']
+
+    starts = range(PAGE_SIZE, first['total'], PAGE_SIZE)
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    try:
+        futures = [(s, executor.submit(_fetch_page, {**base_params, "start": s})) for s in starts]
+        for start, future in futures:
+            yield start, future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def fetch_deals_from_bitrix(days=1):
+
+    since_date = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
+    print(f"Fetching Calls Modified ( Updated) since {since_date}...")
+
+    base_params = {
+        "filter": {">=Call_Start_Date": since_date},
+        "select": ["*"], 
+
+        "order": {"Call_Start_Date": "ASC"}, 
+    }
+
+    # The first page tells us the total, the rest are fetched concurrently
+    # (or by following `next` when Bitrix doesn't report a total)
+    data = _fetch_page({**base_params, "start": 0})
+    if data is None:
+        return pd.DataFrame()
+
+    # Last-seen row per ID, updated as pages arrive (pages are consumed in order).
+    # Keyed by int(ID): call IDs are numeric strings and int hashing is cheaper;
+    # the row's own ID value is left untouched.
+    by_id = {}
+    first = data.get('result', [])
+    for r in first:
+        by_id[int(r['ID'])] = r
+    collected = len(first)
+    print(f"   Fetched batch (start=0)... Total collected: {collected} of {data.get('total', '?')}")
+
+    if 'next' in data and collected >= PAGE_SIZE:
+        with closing(_iter_pages(base_params, data)) as pages:
+            for start, page in pages:
+                if page is None:
+                    print(f" Stopping at start {start}.")
+                    break
+                batch = page.get('result', [])
+                if not batch:
+                    break
+                for r in batch:
+                    by_id[int(r['ID'])] = r
+                collected += len(batch)
+                print(f"   Fetched batch (start={start})... Total collected: {collected}")
+
+    # Plain constructor: it keeps Bitrix's key order and, on these mostly
+    # string/mixed rows, beat building per-column Arrow arrays
+    df = pd.DataFrame(list(by_id.values()))
+
+    df = normalize_missing(df)
+
     print(f"Total Unique Deals: {len(df)}")
     return df
     
@@ -1,14 +1,13 @@
 import pandas as pd
 import re
 import unicodedata
-import requests
 import json
 import io
-import gc
-import time
 from datetime import datetime
+from functools import lru_cache
 from google.cloud import storage
 from google.cloud import bigquery
+from extract import bitrix_list_all
 
 # --- Configuration ---
 
@@ -21,21 +20,53 @@ MAIN_TABLE_ID = "Crm_Calls"
 STAGING_TABLE_ID = "Crm_Calls_Staging" 
 BITRIX_WEBHOOK = "https://diet-hub.bitrix24.com/rest/625003/f2ijr5q7sa4w5z6g/"
 
+# Precompiled patterns used on every row
+_DIGITS = re.compile(r'\D')
+_TZ = re.compile(r'[+-]\d{2}:?\d{2}$')
+_TZ_LETTERS = re.compile(r'[TZ]')
+_MILLIS = re.compile(r'\.\d+')
+_WA = re.compile(r'(?i)^Whatsapp($|\s[^-]| -[^-])')
+_SALES_WA = re.compile(r'(?i)^Sales\s*Whatsapp')
+
+
+ARABIC_DIGITS = {'٠':'0', '١':'1', '٢':'2', '٣':'3', '٤':'4',
+                 '٥':'5', '٦':'6', '٧':'7', '٨':'8', '٩':'9'}
+
+# Strips the whole Arabic block (U+0600-U+06FF) except the digits, which are
+# mapped to their Western equivalents in the same pass.
+_AR_TABLE = str.maketrans({
+    **{cp: None for cp in range(0x0600, 0x0700)},
+    **{ord(arabic): western for arabic, western in ARABIC_DIGITS.items()},
+})
+
+# Arrow-backed string dtype for the regex-heavy column passes
+_ARROW_STRING = pd.StringDtype('pyarrow')
+
 
 def normalize_arabic(text):
     if pd.isna(text): return ""
-    if text is False: return ""
-    
-    arabic_digits = {'٠':'0', '١':'1', '٢':'2', '٣':'3', '٤':'4',
-                     '٥':'5', '٦':'6', '٧':'7', '٨':'8', '٩':'9'}
-    text = str(text)
-    for arabic, western in arabic_digits.items():
-        text = text.replace(arabic, western)
-    text = re.sub(r'[\u0600-\u06FF]', '', text)
-    text = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode('utf-8')
+
+    text = str(text).translate(_AR_TABLE)
+    text = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode('ascii')
     return text.strip()
 
 
+def normalize_arabic_series(series):
+    """
+    Vectorized normalize_arabic: same cleaning applied column-wise.
+    Missing values stay missing instead of becoming "".
+    """
+    return (
+        series.astype('string')
+        .str.translate(_AR_TABLE)
+        .str.normalize('NFKD')
+        .str.encode('ascii', 'ignore')
+        .str.decode('ascii')
+        .astype('string')
+        .str.strip()
+    )
+
+
 def normalize_lists(val):
     """
     Fix for 'cannot mix list and non-list':
@@ -43,8 +74,6 @@ def normalize_lists(val):
     """
     if isinstance(val, list):
         return ", ".join([str(v) for v in val if v])
-    if val is False: 
-        return None
     return val
 
 
@@ -64,7 +93,7 @@ def extract_last_10_digits(text):
     elif ' - ' in text and len(text) > 20: 
         text = text.split(' - ')[0]
 
-    digits = re.sub(r'\D', '', text) 
+    digits = _DIGITS.sub('', text) 
     
     if len(digits) >= 10:
         return digits[-10:]
@@ -72,33 +101,61 @@ def extract_last_10_digits(text):
     return None
 
 
+def extract_last_10_digits_series(series):
+    """
+    Vectorized extract_last_10_digits: same rules, applied column-wise.
+    Runs on Arrow-backed strings so the regexes execute in Arrow's C++
+    kernels; the (per-element) Arabic normalization only touches rows that
+    actually contain non-ASCII text.
+    """
+    text = series.astype(_ARROW_STRING)
+
+    non_ascii = text.str.contains(r'[^\x00-\x7F]', regex=True).fillna(False)
+    if non_ascii.any():
+        text = text.mask(non_ascii, normalize_arabic_series(text[non_ascii]).astype(_ARROW_STRING))
+    text = text.str.strip()
+
+    # The ' - ' cut only applies to long rows without a comma
+    has_comma = text.str.contains(',', regex=False).fillna(False)
+    long_dash = ~has_comma & (text.str.len() > 20).fillna(False) & text.str.contains(' - ', regex=False).fillna(False)
+
+    text = text.str.replace(r'(?s),.*', '', regex=True)
+    if long_dash.any():
+        text = text.mask(long_dash, text[long_dash].str.replace(r'(?s) - .*', '', regex=True))
+
+    # Plain pattern strings keep the Arrow kernels (compiled patterns fall back to Python)
+    digits = text.str.replace(_DIGITS.pattern, '', regex=True)
+    return digits.where(digits.str.len() >= 10).str.slice(-10)
+
+
+DATE_FORMATS = [
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%d %H:%M',
+    '%Y-%m-%d',
+    '%d/%m/%Y %H:%M:%S',
+    '%m/%d/%Y %H:%M:%S',
+    '%d-%m-%Y',
+    '%d/%m/%Y',
+    '%Y/%m/%d',
+    '%Y%m%d',
+]
+
+
 def fix_date_format(date_str):
-    if pd.isna(date_str) or str(date_str).strip() in ['', 'nan', 'None', 'NaT', 'False']:
+    if pd.isna(date_str):
         return None
 
     date_str = normalize_arabic(str(date_str)).strip()
 
     # Remove Timezone Offset (e.g., +03:00) at the end
-    date_str = re.sub(r'[+-]\d{2}:?\d{2}$', '', date_str) 
+    date_str = _TZ.sub('', date_str) 
 
     # Clean T/Z and milliseconds
-    date_str = re.sub(r'[TZ]', ' ', date_str) 
-    date_str = re.sub(r'\.\d+', '', date_str)  
+    date_str = _TZ_LETTERS.sub(' ', date_str) 
+    date_str = _MILLIS.sub('', date_str)  
     date_str = date_str.strip()
 
-    formats_to_try = [
-        '%Y-%m-%d %H:%M:%S',
-        '%Y-%m-%d %H:%M',
-        '%Y-%m-%d',
-        '%d/%m/%Y %H:%M:%S',
-        '%m/%d/%Y %H:%M:%S',
-        '%d-%m-%Y',
-        '%d/%m/%Y',
-        '%Y/%m/%d',
-        '%Y%m%d',
-    ]
-
-    for fmt in formats_to_try:
+    for fmt in DATE_FORMATS:
         try:
             dt = datetime.strptime(date_str, fmt)
             return dt.strftime('%Y-%m-%d') 
@@ -115,22 +172,53 @@ def fix_date_format(date_str):
     return None
 
 
+def vec_fix_date(series):
+    """
+    Vectorized fix_date_format: each candidate format is parsed once over
+    the rows that are still unparsed, instead of strptime per row.
+    """
+    s = (
+        normalize_arabic_series(series)
+        .str.replace(_TZ, '', regex=True)
+        .str.replace(_TZ_LETTERS, ' ', regex=True)
+        .str.replace(_MILLIS, '', regex=True)
+        .str.strip()
+    )
+
+    # Fast path: Bitrix timestamps are ISO-8601 (e.g. 2024-05-01T12:34:56+03:00),
+    # so after the offset/T cleanup most rows parse in this single C pass
+    out = _to_ns(pd.to_datetime(s, format='ISO8601', errors='coerce'))
+    for fmt in DATE_FORMATS:
+        mask = out.isna() & s.notna()
+        if not mask.any():
+            break
+        out.loc[mask] = _to_ns(pd.to_datetime(s[mask], format=fmt, errors='coerce'))
+
+    # Last resort, same as fix_date_format: let pandas infer each row's layout
+    mask = out.isna() & s.notna()
+    if mask.any():
+        out.loc[mask] = _to_ns(pd.to_datetime(s[mask], errors='coerce', dayfirst=True, format='mixed'))
+
+    return out.dt.strftime('%Y-%m-%d')
+
+
+def _to_ns(parsed):
+    """
+    Coerces parsed dates outside the datetime64[ns] range (e.g. year 1) to
+    NaT so they can be assigned into a nanosecond Series.
+    """
+    parsed = parsed.where((parsed >= pd.Timestamp.min) & (parsed <= pd.Timestamp.max))
+    return parsed.astype('datetime64[ns]')
+
+
 def convert_to_strict_date(series):
-    clean_series = series.apply(lambda x: normalize_arabic(str(x)) if pd.notnull(x) else None)
-    
+    clean_series = normalize_arabic_series(series)
+
     dt_series = pd.to_datetime(clean_series, errors='coerce', dayfirst=True, utc=True)
-    
-    mask_fail = dt_series.isna() & clean_series.notnull()
-    if mask_fail.any():
-        try:
-            dt_series.loc[mask_fail] = pd.to_datetime(
-                clean_series.loc[mask_fail], 
-                format='%Y-%d-%m', 
-                errors='coerce', 
-                utc=True
-            )
-        except:
-            pass
+
+    # Retry failures with the swapped day/month layout in one vectorized pass
+    fallback = pd.to_datetime(clean_series, format='%Y-%d-%m', errors='coerce', utc=True)
+    dt_series = dt_series.where(dt_series.notna(), fallback)
 
     if pd.api.types.is_datetime64tz_dtype(dt_series):
         dt_series = dt_series.dt.tz_localize(None)
@@ -139,55 +227,22 @@ def convert_to_strict_date(series):
 
 
 def fetch_all_bitrix_users():
-    all_users = []
-    start = 0
-
-    while True:
-        params = {"start": start}
-        res = requests.post(f"{BITRIX_WEBHOOK}/user.get", json=params, timeout=60).json()
-
-        batch = res.get("result", [])
-        if not batch:
-            break
-
-        all_users.extend(batch)
-
-        if "next" in res:
-            start = res["next"]
-        else:
-            break
-
-    return all_users
+    return bitrix_list_all("user.get")
 
 
 def fetch_sip_lines_map():
     sip_map = {}
-    start = 0
     print("Fetching Voximplant SIP lines...")
 
-    while True:
-        params = {"start": start}
-        try:
-            res = requests.post(f"{BITRIX_WEBHOOK}/voximplant.sip.get", json=params, timeout=60).json()
-            batch = res.get("result", [])
-            if not batch:
-                break
-
-            for item in batch:
-                reg_id = item.get('REG_ID')
-                title = item.get('TITLE')
-                if reg_id and title:
-                    key = f"reg{reg_id}"
-                    sip_map[key] = title
-
-            if "next" in res:
-                start = res["next"]
-                time.sleep(0.5)
-            else:
-                break
-        except Exception as e:
-            print(f"Error fetching SIP lines: {e}")
-            break
+    try:
+        for item in bitrix_list_all("voximplant.sip.get"):
+            reg_id = item.get('REG_ID')
+            title = item.get('TITLE')
+            if reg_id and title:
+                key = f"reg{reg_id}"
+                sip_map[key] = title
+    except Exception as e:
+        print(f"Error fetching SIP lines: {e}")
 
     print(f"Mapped {len(sip_map)} SIP lines.")
     return sip_map
@@ -214,57 +269,97 @@ def get_bitrix_maps():
     return maps
 
 
-def process_source(row):
-    source_val = row.get('SOURCE_ID', row.get('source', ''))
-    contact_val = row.get('CONTACT_SOURCE', '')
-    source_str = normalize_arabic(source_val) if not pd.isna(source_val) else ''
-    contact_str = normalize_arabic(contact_val) if not pd.isna(contact_val) else ''
-    
-    valid_sources = ['Instagram - Diet Hub', 'Facebook - Diet Hub', 'Instagram - Jidalur',
-                     'Facebook - Jidalur', 'Facebook - Beltix', 'Instagram - Beltix', 
-                     'IG Lead generation', 'Lead generation']
-
-    if source_str in ['Whatsapp - Marketing', 'Whatsapp - Mou']: return source_str
-    if re.match(r'(?i)^Whatsapp($|\s[^-]| -[^-])', source_str): return 'WhatsApp'
-    if source_str in ['Instant form', 'Lead generation', 'IG lead generation']: return source_str
-    if source_str in valid_sources: return source_str
-    if source_str == 'CRM form': return 'Others'
-    if source_str == 'Callback': return 'Call'
-    if source_str == 'IG to site': return 'Ig to site'
-    if source_str == 'FB To Website': return 'FB To Website'
-    if contact_str in valid_sources: return contact_str
-    if re.match(r'(?i)^Sales\s*Whatsapp', source_str): return 'WhatsApp'
-    return source_str if source_str and source_str != 'nan' else 'Others'
-
-
-def get_best_phone(row):
-    # --- PRIORITY 1: The Phone Column ---
-    phone_col_val = row.get('UF_CRM_1725452218751')
-    
-    # Clean it
-    clean_phone = extract_last_10_digits(phone_col_val)
-    
-    if clean_phone:
-        return clean_phone 
+VALID_SOURCES = ['Instagram - Diet Hub', 'Facebook - Diet Hub', 'Instagram - Jidalur',
+                 'Facebook - Jidalur', 'Facebook - Beltix', 'Instagram - Beltix', 
+                 'IG Lead generation', 'Lead generation']
 
-    # --- PRIORITY 2: The Title Column ---
-    title_val = row.get('TITLE')
-    
-    # Fixed: Use extract_last_10_digits instead of undefined extract_phone_from_title
-    clean_phone_title = extract_last_10_digits(title_val)
-    
-    if clean_phone_title:
-        return clean_phone_title
+# Literal source values and what they map to (kept in their original precedence)
+SOURCE_LOOKUP = {
+    'Whatsapp - Marketing': 'Whatsapp - Marketing',
+    'Whatsapp - Mou': 'Whatsapp - Mou',
+    'Instant form': 'Instant form',
+    'IG lead generation': 'IG lead generation',
+    **{src: src for src in VALID_SOURCES},
+    'CRM form': 'Others',
+    'Callback': 'Call',
+    'IG to site': 'Ig to site',
+    'FB To Website': 'FB To Website',
+}
 
-    # --- Final Fallback ---
-    return None
 
+def process_source(df):
+    if 'SOURCE_ID' in df.columns:
+        source_val = df['SOURCE_ID']
+    else:
+        source_val = df.get('source', pd.Series(None, index=df.index, dtype=object))
+    contact_val = df.get('CONTACT_SOURCE', pd.Series(None, index=df.index, dtype=object))
+
+    source_str = normalize_arabic_series(source_val).fillna('')
+    contact_str = normalize_arabic_series(contact_val).fillna('')
+
+    out = source_str.map(SOURCE_LOOKUP)
+    out = out.mask(out.isna() & source_str.str.match(_WA), 'WhatsApp')
+    out = out.mask(out.isna() & contact_str.isin(VALID_SOURCES), contact_str)
+    out = out.mask(out.isna() & source_str.str.match(_SALES_WA), 'WhatsApp')
+
+    keep_raw = (source_str != '') & (source_str != 'nan')
+    return out.fillna(source_str.where(keep_raw)).fillna('Others')
+
+
+def get_best_phone(df):
+    # The phone column wins; TITLE only fills rows where it has no number
+    best = pd.Series(None, index=df.index, dtype=object)
+    for col in ['UF_CRM_1725452218751', 'TITLE']:
+        if col in df.columns:
+            best = best.combine_first(extract_last_10_digits_series(df[col]))
+
+    return best
 
-def fill_date_fallback(row):
-    val = row.get('UF_CRM_1736158245296') # code of Creation Date
-    if pd.isna(val) or val is False or str(val).strip() == '':
-        return row.get('DATE_CREATE')
-    return val
+
+def vec_fill_date(df):
+    # code of Creation Date; missing values are already pd.NA after ingest.
+    # Either column may be absent, like row.get() allowed before.
+    missing = pd.Series(pd.NA, index=df.index, dtype=object)
+    val = df.get('UF_CRM_1736158245296', missing)
+    return val.combine_first(df.get('DATE_CREATE', missing))
+
+
+def load_staging(df, client):
+    """
+    Loads the frame into the staging table as Parquet (WRITE_TRUNCATE),
+    so run_bigquery_merge can merge it into the main table.
+    """
+    full_staging_ref = f"{PROJECT_ID}.{DATASET_ID}.{STAGING_TABLE_ID}"
+
+    buf = io.BytesIO()
+    df.to_parquet(buf, engine='pyarrow', compression='snappy', index=False)
+    buf.seek(0)
+
+    job_config = bigquery.LoadJobConfig(
+        source_format=bigquery.SourceFormat.PARQUET,
+        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+    )
+
+    print(f"Loading {len(df)} rows into {full_staging_ref}...")
+    client.load_table_from_file(buf, full_staging_ref, job_config=job_config).result()
+
+
+def _fetch_schema_map(client, table_ref):
+    """
+    Column name (upper-cased) -> BigQuery type for a table.
+    """
+    table = client.get_table(table_ref)
+    return {field.name.upper(): field.field_type for field in table.schema}
+
+
+# Cached per client/table; only for tables whose schema is stable (the main
+# table). The staging table is rebuilt by every load, so it is always fetched.
+# Call _schema_map.cache_clear() after changing a cached table's schema.
+_schema_map = lru_cache(maxsize=16)(_fetch_schema_map)
+
+
+# Timestamp columns used to pick the latest staging row per ID, in preference order
+MERGE_ORDER_COLUMNS = ['DATE_MODIFY', 'CALL_START_DATE']
 
 
 def run_bigquery_merge(client, df_columns):
@@ -277,12 +372,17 @@ def run_bigquery_merge(client, df_columns):
     print(f"Fetching schema for {full_main_ref} to ensure type safety...")
     
     try:
-        main_table = client.get_table(full_main_ref)
-        schema_map = {field.name.upper(): field.field_type for field in main_table.schema}
+        schema_map = _schema_map(client, full_main_ref)
     except Exception as e:
         print(f"Could not fetch main table schema: {e}")
         schema_map = {}
 
+    try:
+        staging_map = _fetch_schema_map(client, full_staging_ref)
+    except Exception as e:
+        print(f"Could not fetch staging table schema: {e}")
+        staging_map = {}
+
     update_list = []
     insert_cols = []
     insert_vals = []
@@ -291,7 +391,7 @@ def run_bigquery_merge(client, df_columns):
         col_upper = col.upper()
         target_type = schema_map.get(col_upper)
         
-        if target_type == 'STRING':
+        if target_type == 'STRING' and staging_map.get(col_upper) != target_type:
             src_val = f"CAST(S.{col} AS STRING)"
         elif target_type in ['TIMESTAMP', 'DATE', 'DATETIME']:
             src_val = f"S.{col}" 
@@ -308,9 +408,20 @@ def run_bigquery_merge(client, df_columns):
     insert_cols_str = ", ".join(insert_cols)
     insert_vals_str = ", ".join(insert_vals)
 
+    # Keep only the latest staging row per ID, otherwise MERGE fails on duplicates
+    cols_by_upper = {c.upper(): c for c in df_columns}
+    order_col = next((cols_by_upper[c] for c in MERGE_ORDER_COLUMNS if c in cols_by_upper), None)
+    order_clause = f"ORDER BY {order_col} DESC" if order_col else ""
+
     sql = f"""
         MERGE `{full_main_ref}` T
-        USING `{full_staging_ref}` S
+        USING (
+          SELECT * EXCEPT(_rn) FROM (
+            SELECT *, ROW_NUMBER() OVER (PARTITION BY ID {order_clause}) AS _rn
+            FROM `{full_staging_ref}`
+          )
+          WHERE _rn = 1
+        ) S
         ON T.ID = S.ID
         WHEN MATCHED THEN
           UPDATE SET {update_clause}